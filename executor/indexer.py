@@ -1,12 +1,11 @@
 import os
-from collections import OrderedDict
-from copy import deepcopy
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Union
 
 import faiss
 import numpy as np
-from bidict import bidict
 from bloom_filter2 import BloomFilter
 from jina import Document, DocumentArray, Executor, requests
 from docarray.score import NamedScore
@@ -15,6 +14,57 @@ from jina.logging.logger import JinaLogger
 from .storage import StorageFactory
 
 
+def _normalize_inplace(x: np.ndarray):
+    """L2-normalize the rows of a float matrix in place, leaving zero rows untouched.
+
+    The division is skipped when all the rows are already unit-norm.
+    """
+    norms_sq = np.einsum('ij,ij->i', x, x)
+    if len(norms_sq) == 0 or np.max(np.abs(norms_sq - 1.0)) < 1e-4:
+        return
+    norms = np.sqrt(norms_sq)[:, None]
+    np.divide(x, norms, out=x, where=norms > 0)
+
+
+def _stack_embeddings(docs: DocumentArray) -> np.ndarray:
+    """Copy the doc embeddings into one preallocated C-ordered float32 matrix."""
+    embeddings = np.empty((len(docs), docs[0].embedding.shape[-1]), dtype=np.float32)
+    for i, doc in enumerate(docs):
+        # the row assignment casts to float32, no intermediate stacked copy is made
+        embeddings[i] = doc.embedding
+    return embeddings
+
+
+def _top_k(scores: np.ndarray, ids: np.ndarray, k: int):
+    """Keep the (unordered) ``k`` highest scores of each row and their ids."""
+    num_cols = scores.shape[1]
+    if num_cols <= k:
+        return scores, ids
+    top = np.argpartition(scores, num_cols - k, axis=1)[:, num_cols - k :]
+    return (
+        np.take_along_axis(scores, top, axis=1),
+        np.take_along_axis(ids, top, axis=1),
+    )
+
+
+def _grow(arr: np.ndarray, size: int) -> np.ndarray:
+    """Return ``arr`` zero-padded to hold at least ``size`` rows, doubling its capacity."""
+    if size <= len(arr):
+        return arr
+    grown = np.zeros((max(size, 2 * len(arr)),) + arr.shape[1:], dtype=arr.dtype)
+    grown[: len(arr)] = arr
+    return grown
+
+
+# flat inner product search of query batches runs as NumPy sgemm over blocks of
+# at most _MATMUL_MAX_SCORES scores (16 MB), smaller batches are left to Faiss
+_MATMUL_MIN_QUERIES = 16
+_MATMUL_MAX_SCORES = 1 << 22
+
+# the kwargs which change how the Faiss index is built
+_INDEX_PARAMS = ('n_links', 'efSearch', 'efConstruction', 'nprobe', 'training_fraction')
+
+
 class FaissIndexer(Executor):
     """A vector similarity indexer for very large scale data using Faiss.
 
@@ -28,6 +78,7 @@ class FaissIndexer(Executor):
         index_key: str = 'Flat',
         metric: str = 'cosine',
         trained_index_file: Optional[str] = None,
+        use_gpu: bool = False,
         *args,
         **kwargs,
     ):
@@ -43,22 +94,40 @@ class FaissIndexer(Executor):
                         HNSW256, efConstruction=256 and efSearch=256
                     - "IVFx,Flat": Inverted Index. Replace x with the number of centroids aka nlist.
                         Rule of thumb: nlist = 10 * sqrt (num_docs) is a good starting point.
+                    - "SQ8" / "SQfp16": Exact scan over 8bit / float16 scalar quantized vectors,
+                        i.e., 4x / 2x less memory to read per query than "Flat".
+                    - "IVFx,PQmxn" / "IVFx,SQ8": Inverted Index with compressed vectors, e.g.,
+                        "IVF1024,PQ16x8" stores 16 bytes per vector. ``nprobe`` defaults to nlist // 32.
+                    Indexes which need training (IVF, PQ, SQ) are trained on the stored documents
+                    when the indexer is built (at startup or on ``/sync``), using a random
+                    ``training_fraction`` (default 1.0) of them.
                     For more details see:
                     - Overview of indices https://github.com/facebookresearch/faiss/wiki/Faiss-indexes
                     - Guideline for choosing an index https://github.com/facebookresearch/faiss/wiki/Guidelines-to-choose-an-index
                     - FAISS Index factory https://github.com/facebookresearch/faiss/wiki/The-index-factory
         :param trained_index_file: the index file dumped from a trained index, e.g., ``faiss.index``.
+        :param use_gpu: move the Faiss index to all the available GPUs (requires ``faiss-gpu``).
+                Falls back to the CPU index when no GPU is found or the index type is not
+                supported on GPU (e.g., HNSW).
         """
         super().__init__(*args, **kwargs)
         self.logger = JinaLogger(self.__class__.__name__)
 
         self.index_key = index_key
         self.metric = metric
+        self.use_gpu = use_gpu
+
+        self._check_faiss_build()
 
         workspace = Path(self.workspace)
         storage_path = str(workspace / 'lmdb_docs')
+        self._index_path = workspace / 'index.faiss'
+        self._metas_path = workspace / 'metas.pkl'
 
-        self._metas = {'doc_id_to_offset': bidict(), 'delete_marks': []}
+        self._metas = self._init_metas()
+        self._num_deletes = 0
+        # set when the storage is written without syncing the Faiss index
+        self._index_outdated = False
 
         self._bloom = self._init_bloom()
 
@@ -68,19 +137,35 @@ class FaissIndexer(Executor):
 
         # the buffer_indexer is created for incremental updates
         self._buffer_indexer = DocumentArray()
+        # the (normalized) embeddings of the buffer_indexer, rebuilt lazily after changes
+        self._buffer_embeddings = None
 
         # the vec_indexer is created for incremental indexing
         self._vec_indexer = None
+        # set once the vec_indexer is actually moved to GPU
+        self._on_gpu = False
+        self._trained_index_file = trained_index_file
+        self._add_executor = ThreadPoolExecutor(max_workers=1)
         if trained_index_file:
             if os.path.exists(trained_index_file):
                 self._vec_indexer = faiss.read_index(trained_index_file)
+                if 'nprobe' in kwargs:
+                    self._set_nprobe(self._vec_indexer, **kwargs)
+                self._vec_indexer = self._to_gpu(self._vec_indexer)
             else:
                 raise ValueError(
                     f'The trained index file {trained_index_file} does not exist!'
                 )
 
         self._index_kwargs = kwargs
-        self._vec_indexer = self._build_indexer(self._vec_indexer, **kwargs)
+        if not self._load_checkpoint():
+            self._vec_indexer = self._build_indexer(self._vec_indexer, **kwargs)
+
+    def close(self):
+        """Dump the Faiss index and its metadata, so that the next start skips rebuilding."""
+        self._add_executor.shutdown()
+        self._save_checkpoint()
+        super().close()
 
     @requests(on='/index')
     def index(self, docs: DocumentArray, parameters: Optional[Dict] = None, **kwargs):
@@ -94,22 +179,57 @@ class FaissIndexer(Executor):
 
         sync = parameters.get('sync', True) if parameters else True
 
-        self._kv_db.put(docs)
+        if not sync:
+            self._kv_db.put(docs)
+            self._index_outdated = True
+            return
 
-        if sync:
-            new_docs, exist_docs = self.bloom_filter(docs)
-            if len(new_docs) > 0:
-                doc_ids = new_docs[:, 'id']
-                embeddings = new_docs.embeddings
-                self._vec_indexer = self._add_vecs_with_ids(
-                    self._vec_indexer, embeddings, doc_ids
-                )
-            if len(exist_docs) > 0:
-                self.update(docs, parameters=parameters)
+        doc_ids = docs[:, 'id']
+        embeddings = _stack_embeddings(docs)
+        new_mask = np.fromiter(
+            (doc_id not in self._bloom for doc_id in doc_ids),
+            dtype=bool,
+            count=len(doc_ids),
+        )
+
+        # Faiss releases the GIL while adding vectors, so the new vectors are indexed
+        # in the worker thread while the docs are written to the storage.
+        add_future = None
+        num_indexes = self.total_indexes
+        if new_mask.any():
+            new_ids = [doc_id for doc_id, is_new in zip(doc_ids, new_mask) if is_new]
+            add_future = self._add_executor.submit(
+                self._add_vecs_with_ids,
+                self._vec_indexer,
+                embeddings[new_mask],
+                new_ids,
+            )
+        try:
+            self._kv_db.put(docs)
+        except Exception:
+            # the docs are not stored, so their vectors must not be searchable
+            if add_future is not None and add_future.exception() is None:
+                self._vec_indexer = add_future.result()
+                self._rollback_add(num_indexes, new_ids)
+            raise
+        if add_future is not None:
+            self._vec_indexer = add_future.result()
+
+        if not new_mask.all():
+            # the docs are already written by the put above, only buffer them
+            self._buffer_indexer.extend(docs[(~new_mask).tolist()])
+            self._buffer_embeddings = None
 
     @requests(on='/search')
     def search(self, docs: DocumentArray, parameters: Optional[Dict] = None, **kwargs):
+        """Search the top_k nearest docs of each query
+        :param docs: the query documents
+        :param parameters: parameters to the request, e.g., ``top_k`` (default 10) and
+            ``return_docs`` (default True). With ``return_docs=False`` the matches only
+            carry the id and the score, and the docs are not read from the storage.
+        """
         top_k = int(parameters.get('top_k', 10)) if parameters else 10
+        return_docs = parameters.get('return_docs', True) if parameters else True
         if (docs is None) or len(docs) == 0:
             return
 
@@ -121,10 +241,11 @@ class FaissIndexer(Executor):
             self.logger.warning(f'The indexer need to be trained!')
             return
 
-        embeddings = docs.embeddings.astype(np.float32)
+        # C-ordered float32 rows, so that Faiss does not copy the queries again
+        embeddings = _stack_embeddings(docs)
 
         if self.metric == 'cosine':
-            faiss.normalize_L2(embeddings)
+            _normalize_inplace(embeddings)
 
         if self.total_deletes > 100:
             self.logger.warning(
@@ -134,23 +255,40 @@ class FaissIndexer(Executor):
 
         expand_top_k = 2 * top_k + self.total_deletes
 
-        dists, ids = self._vec_indexer.search(embeddings, expand_top_k)
+        dists, ids = self._search_vecs(embeddings, expand_top_k)
         if self.metric == 'cosine':
             dists = 1.0 - dists
 
-        if len(self._buffer_indexer) > 0:
-            match_args = {'limit': top_k, 'metric': self.metric}
-            docs.match(self._buffer_indexer, **match_args)
-
-        for doc_idx, matches in enumerate(zip(ids, dists)):
-            buffer_matched_docs = deepcopy(docs[doc_idx].matches)
-            matched_docs = OrderedDict()
-            for m_info in zip(*matches):
-                idx, dist = m_info
-                if idx < 0 or self._metas['delete_marks'][idx]:
+        buffer_matches = self._match_buffer(docs, embeddings, top_k)
+
+        # drop padded (-1) and deleted offsets for the whole batch at once
+        valid = ids >= 0
+        valid[valid] = self._metas['delete_marks'][ids[valid]] == 0
+
+        # fetch all matched docs of the batch from the storage in one round-trip
+        stored_docs = {}
+        if return_docs:
+            match_doc_ids = self._metas['doc_ids'][np.unique(ids[valid])].tolist()
+            stored_docs = {d.id: d for d in self._kv_db.get(match_doc_ids)}
+        used_doc_ids = set()
+
+        for doc_idx, (offsets, match_dists, is_valid) in enumerate(
+            zip(ids, dists, valid)
+        ):
+            buffer_matched_docs = buffer_matches[doc_idx]
+            matched_docs: Dict[str, Document] = {}
+            for idx, dist in zip(offsets[is_valid], match_dists[is_valid]):
+                match_doc_id = self._metas['doc_ids'][idx]
+                if not return_docs:
+                    match = Document(id=match_doc_id)
+                elif match_doc_id not in stored_docs:
                     continue
-                match_doc_id = self._metas['doc_id_to_offset'].inverse[idx]
-                match = self.get_doc(match_doc_id)
+                elif match_doc_id in used_doc_ids:
+                    # the same doc is matched by several queries, scores are per query
+                    match = Document(stored_docs[match_doc_id], copy=True)
+                else:
+                    match = stored_docs[match_doc_id]
+                used_doc_ids.add(match_doc_id)
                 s = NamedScore()
                 s.value = dist
                 s.ref_id = docs[0].id
@@ -160,13 +298,19 @@ class FaissIndexer(Executor):
             # merge search results
             for m in buffer_matched_docs:
                 matched_docs[m.id] = m
-            docs[doc_idx].matches = [
-                m
-                for _, m in sorted(
-                    matched_docs.items(),
-                    key=lambda item: item[1].scores[self.metric].value,
-                )
-            ][:top_k]
+            merged_docs = list(matched_docs.values())
+            merged_scores = np.fromiter(
+                (m.scores[self.metric].value for m in merged_docs),
+                dtype=np.float32,
+                count=len(merged_docs),
+            )
+            if top_k < len(merged_docs):
+                # partial sort: select the top_k first, then only order those
+                order = np.sort(np.argpartition(merged_scores, top_k - 1)[:top_k])
+            else:
+                order = np.arange(len(merged_docs))
+            order = order[np.argsort(merged_scores[order], kind='stable')]
+            docs[doc_idx].matches = [merged_docs[i] for i in order]
 
 
     @requests(on='/update')
@@ -184,6 +328,9 @@ class FaissIndexer(Executor):
         sync = parameters.get('sync', True) if parameters else True
         if sync:
             self._buffer_indexer.extend(docs)
+            self._buffer_embeddings = None
+        else:
+            self._index_outdated = True
 
     @requests(on='/delete')
     def delete(self, parameters: Dict, **kwargs):
@@ -196,10 +343,13 @@ class FaissIndexer(Executor):
         # delete from buffer_indexer
         for doc_id in deleted_ids:
             idx = self._metas['doc_id_to_offset'][doc_id]
-            self._metas['delete_marks'][idx] = 1
+            if not self._metas['delete_marks'][idx]:
+                self._metas['delete_marks'][idx] = 1
+                self._num_deletes += 1
 
             if doc_id in self._buffer_indexer:
                 del self._buffer_indexer[doc_id]
+                self._buffer_embeddings = None
 
     @requests(on='/sync')
     def sync(self, **kwargs):
@@ -207,9 +357,12 @@ class FaissIndexer(Executor):
         if self._vec_indexer:
             self._vec_indexer.reset()
         self._bloom = self._init_bloom()
-        self._metas = {'doc_id_to_offset': bidict(), 'delete_marks': []}
+        self._metas = self._init_metas()
+        self._num_deletes = 0
+        self._index_outdated = False
         self._vec_indexer = self._build_indexer(self._vec_indexer)
         self._buffer_indexer.clear()
+        self._buffer_embeddings = None
 
     @requests(on='/clear')
     def clear(self, **kwargs):
@@ -218,7 +371,10 @@ class FaissIndexer(Executor):
         if self._vec_indexer:
             self._vec_indexer.reset()
         self._buffer_indexer.clear()
-        self._metas = {'doc_id_to_offset': bidict(), 'delete_marks': []}
+        self._buffer_embeddings = None
+        self._metas = self._init_metas()
+        self._num_deletes = 0
+        self._index_outdated = False
         self._bloom = self._init_bloom()
 
     @requests(on='/status')
@@ -230,17 +386,108 @@ class FaissIndexer(Executor):
         status.tags['total_deletes'] = self.total_deletes
         return status
 
+    def _save_checkpoint(self):
+        if (
+            self._vec_indexer is None
+            or not self._vec_indexer.is_trained
+            or len(self._buffer_indexer) > 0
+            or self._index_outdated
+        ):
+            # the index misses some storage writes, it must be rebuilt at the next start
+            return
+
+        faiss.write_index(self._to_cpu(self._vec_indexer), str(self._index_path))
+        with open(self._metas_path, 'wb') as f:
+            pickle.dump(
+                {
+                    'metas': self._metas,
+                    'num_deletes': self._num_deletes,
+                    'storage_size': self._kv_db.size,
+                    'index_key': self.index_key,
+                    'metric': self.metric,
+                    'index_params': self._index_params(),
+                },
+                f,
+            )
+        self.logger.info(f'Saved the index checkpoint to {self._index_path}')
+
+    def _load_checkpoint(self):
+        if not (self._index_path.exists() and self._metas_path.exists()):
+            return False
+
+        with open(self._metas_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        indexer = faiss.read_index(str(self._index_path))
+        # the checkpoint is consumed, a crash before the next close forces a rebuild
+        self._index_path.unlink()
+        self._metas_path.unlink()
+
+        if (
+            checkpoint['storage_size'] != self._kv_db.size
+            or checkpoint['index_key'] != self.index_key
+            or checkpoint['metric'] != self.metric
+            or checkpoint['index_params'] != self._index_params()
+        ):
+            self.logger.warning(
+                'The index checkpoint does not match the storage or the index'
+                ' settings, rebuilding the index'
+            )
+            return False
+
+        self._vec_indexer = self._to_gpu(indexer)
+        self._metas = checkpoint['metas']
+        self._num_deletes = checkpoint['num_deletes']
+        num_indexes = indexer.ntotal
+        alive = self._metas['delete_marks'][:num_indexes] == 0
+        for doc_id in self._metas['doc_ids'][:num_indexes][alive]:
+            self._bloom.add(doc_id)
+        self.logger.info(f'Loaded {num_indexes} indexes from the checkpoint')
+        return True
+
+    def _index_params(self):
+        params = {
+            k: self._index_kwargs[k] for k in _INDEX_PARAMS if k in self._index_kwargs
+        }
+        params['trained_index_file'] = self._trained_index_file
+        return params
+
     def get_doc(self, doc_id: str):
         docs = self._kv_db.get(doc_id)
         if len(docs) == 0:
             return None
         return docs[0]
 
+    def _check_faiss_build(self):
+        # the faiss package loads its AVX512/AVX2 extension when the host supports it,
+        # otherwise the generic (much slower) build is used.
+        compile_options = faiss.get_compile_options().split()
+        self.logger.info(f'Faiss compile options: {" ".join(compile_options)}')
+        if not hasattr(faiss, 'supported_instruction_sets'):
+            return
+
+        host_sets = {s.upper() for s in faiss.supported_instruction_sets()}
+        for opt_level in ('AVX512', 'AVX2'):
+            if any(s.startswith(opt_level) for s in host_sets):
+                if opt_level not in compile_options:
+                    self.logger.warning(
+                        f'The host supports {opt_level}, but the loaded Faiss library was not'
+                        f' built with it. Install a Faiss build with {opt_level} support'
+                        ' to speed up the distance computations.'
+                    )
+                break
+
     def _init_bloom(self):
         # max_elements (100M) is how many elements you expect the filter to hold.
         # error_rate defines accuracy;
         return BloomFilter(max_elements=100000000, error_rate=0.01)
 
+    def _init_metas(self):
+        return {
+            'doc_id_to_offset': {},
+            'doc_ids': np.empty(0, dtype=object),
+            'delete_marks': np.zeros(0, dtype=np.uint8),
+        }
+
     def _init_indexer(
         self,
         num_dim: int,
@@ -260,6 +507,11 @@ class FaissIndexer(Executor):
             )
         else:
             indexer = faiss.index_factory(num_dim, index_key, metric_type)
+            if isinstance(indexer, faiss.IndexScalarQuantizer):
+                self.logger.info(
+                    f'Scalar quantizer: {index_key}, {indexer.code_size} bytes/vector'
+                )
+            self._set_nprobe(indexer, **kwargs)
 
         # # Set verbosity level
         # indexer.verbose = self.verbose
@@ -269,18 +521,97 @@ class FaissIndexer(Executor):
         #     indexer.quantizer.verbose = self.verbose
         # if hasattr(indexer, "clustering_index") and indexer.clustering_index is not None:
         #     indexer.clustering_index.verbose = self.verbose
+        return self._to_gpu(indexer)
+
+    def _to_gpu(self, indexer):
+        if not self.use_gpu:
+            return indexer
+        if not hasattr(faiss, 'index_cpu_to_all_gpus') or faiss.get_num_gpus() == 0:
+            self.logger.warning('No GPU is available, the index stays on CPU')
+            return indexer
+
+        try:
+            indexer = faiss.index_cpu_to_all_gpus(indexer)
+        except RuntimeError as ex:
+            self.logger.warning(
+                f'The index can not be moved to GPU, keep it on CPU: {ex}'
+            )
+            return indexer
+        self._on_gpu = True
+        self.logger.info(f'The index is moved to {faiss.get_num_gpus()} GPU(s)')
+        return indexer
+
+    def _to_cpu(self, indexer):
+        if self._on_gpu:
+            return faiss.index_gpu_to_cpu(indexer)
         return indexer
 
+    def _set_nprobe(self, indexer, **kwargs):
+        ivf_indexer = faiss.try_extract_index_ivf(indexer)
+        if ivf_indexer is None:
+            return
+        ivf_indexer.nprobe = kwargs.get('nprobe', max(1, ivf_indexer.nlist // 32))
+        self.logger.info(
+            f'IVF params: nlist: {ivf_indexer.nlist}, nprobe: {ivf_indexer.nprobe}'
+        )
+
     def _build_indexer(self, indexer, **kwargs):
-        for docs in self._kv_db.batched_iterator():
-            doc_ids = docs[:,'id']
+        # read all the stored vectors into one matrix, so that they are added at once
+        num_docs = self._kv_db.size
+        all_doc_ids = []
+        all_embeddings = None
+        for docs in self._kv_db.batched_iterator(batch_size=1024):
+            doc_ids = docs[:, 'id']
             embeddings = docs.embeddings
             N, D = embeddings.shape
             assert len(doc_ids) == N
 
-            indexer = self._add_vecs_with_ids(indexer, embeddings, doc_ids)
+            if all_embeddings is None:
+                all_embeddings = np.empty((num_docs, D), dtype=np.float32)
+            offset = len(all_doc_ids)
+            all_embeddings = _grow(all_embeddings, offset + N)
+            all_embeddings[offset : offset + N] = embeddings
+            all_doc_ids.extend(doc_ids)
             self.append_bloom(docs)
-        return indexer
+
+        if not all_doc_ids:
+            return indexer
+        all_embeddings = all_embeddings[: len(all_doc_ids)]
+
+        if indexer is None:
+            indexer = self._init_indexer(
+                all_embeddings.shape[1],
+                index_key=self.index_key,
+                metric_type=self.metric_type,
+                **self._index_kwargs,
+            )
+        if self.metric == 'cosine':
+            # normalized once here, _add_vecs_with_ids then skips the unit-norm rows
+            _normalize_inplace(all_embeddings)
+        if not indexer.is_trained:
+            self._train_indexer(indexer, all_embeddings)
+        return self._add_vecs_with_ids(indexer, all_embeddings, all_doc_ids)
+
+    def _train_indexer(self, indexer, embeddings: np.ndarray):
+        # the embeddings are expected to be normalized already for cosine
+        training_fraction = self._index_kwargs.get('training_fraction', 1.0)
+        num_train = min(
+            len(embeddings), max(1, int(len(embeddings) * training_fraction))
+        )
+        train_data = embeddings
+        if num_train < len(embeddings):
+            train_ids = np.random.choice(len(embeddings), num_train, replace=False)
+            train_data = embeddings[np.sort(train_ids)]
+
+        self.logger.info(f'Training the indexer with {num_train} vectors')
+        try:
+            indexer.train(train_data)
+        except RuntimeError as ex:
+            # e.g., fewer training vectors than IVF centroids or PQ codes
+            self.logger.warning(
+                f'The indexer can not be trained with {num_train} vectors, it stays'
+                f' untrained: {ex}'
+            )
 
     def _add_vecs_with_ids(
         self, indexer, embeddings: Union[np.ndarray, List], doc_ids: List[str]
@@ -307,19 +638,130 @@ class FaissIndexer(Executor):
                 'The new documents will not be indexed, as the indexer need to been'
                 ' trained'
             )
+            # the stored docs are missing from the index until it is rebuilt
+            self._index_outdated = True
             return indexer
 
         if self.metric == 'cosine':
-            faiss.normalize_L2(embeddings)
+            _normalize_inplace(embeddings)
 
         total_indexes = indexer.ntotal
-        for idx, doc_id in zip(range(total_indexes, total_indexes + num_docs), doc_ids):
-            self._metas['delete_marks'].append(0)
-            self._metas['doc_id_to_offset'][doc_id] = idx
+        for key in ('doc_ids', 'delete_marks'):
+            self._metas[key] = _grow(self._metas[key], total_indexes + num_docs)
+        self._metas['doc_ids'][total_indexes : total_indexes + num_docs] = doc_ids
+        self._metas['doc_id_to_offset'].update(
+            zip(doc_ids, range(total_indexes, total_indexes + num_docs))
+        )
 
         indexer.add(embeddings)
         return indexer
 
+    def _search_vecs(self, embeddings: np.ndarray, top_k: int):
+        indexer = self._vec_indexer
+        num_queries = len(embeddings)
+        if (
+            not isinstance(indexer, faiss.IndexFlat)
+            # get_xb() is only available since faiss 1.7.3
+            or not hasattr(indexer, 'get_xb')
+            or indexer.metric_type != faiss.METRIC_INNER_PRODUCT
+            or indexer.ntotal == 0
+            # single queries are faster with the Faiss SIMD kernels
+            or num_queries < _MATMUL_MIN_QUERIES
+        ):
+            return indexer.search(embeddings, top_k)
+
+        # exact inner product search for query batches: sgemm against a zero-copy
+        # view of the vectors stored in the flat index, block by block to bound
+        # the score matrix, keeping the running top_k of each query
+        num_vecs = indexer.ntotal
+        vecs = faiss.rev_swig_ptr(indexer.get_xb(), num_vecs * indexer.d).reshape(
+            num_vecs, indexer.d
+        )
+        top_k = min(top_k, num_vecs)
+        block_size = max(top_k, _MATMUL_MAX_SCORES // num_queries)
+        best_scores = np.empty((num_queries, 0), dtype=np.float32)
+        best_ids = np.empty((num_queries, 0), dtype=np.int64)
+        for start in range(0, num_vecs, block_size):
+            scores = embeddings @ vecs[start : start + block_size].T
+            ids = np.broadcast_to(
+                np.arange(start, start + scores.shape[1], dtype=np.int64),
+                scores.shape,
+            )
+            scores, ids = _top_k(scores, ids, top_k)
+            best_scores, best_ids = _top_k(
+                np.hstack((best_scores, scores)), np.hstack((best_ids, ids)), top_k
+            )
+
+        order = np.argsort(-best_scores, axis=1)
+        return (
+            np.take_along_axis(best_scores, order, axis=1),
+            np.take_along_axis(best_ids, order, axis=1),
+        )
+
+    def _match_buffer(self, docs: DocumentArray, embeddings: np.ndarray, top_k: int):
+        buffer_matches = [[] for _ in range(len(docs))]
+        num_buffered = len(self._buffer_indexer)
+        top_k = min(top_k, num_buffered)
+        if top_k <= 0:
+            return buffer_matches
+
+        if self._buffer_embeddings is None:
+            self._buffer_embeddings = _stack_embeddings(self._buffer_indexer)
+            if self.metric == 'cosine':
+                _normalize_inplace(self._buffer_embeddings)
+        buffer_embeddings = self._buffer_embeddings
+
+        # the queries are already normalized for cosine, one sgemm scores the whole buffer
+        scores = embeddings @ buffer_embeddings.T
+        if self.metric == 'cosine':
+            dists = 1.0 - scores
+        else:
+            sq_dists = (
+                np.einsum('ij,ij->i', embeddings, embeddings)[:, None]
+                + np.einsum('ij,ij->i', buffer_embeddings, buffer_embeddings)
+                - 2 * scores
+            )
+            dists = np.sqrt(np.maximum(sq_dists, 0))
+
+        if top_k < num_buffered:
+            ids = np.argpartition(dists, top_k - 1, axis=1)[:, :top_k]
+            dists = np.take_along_axis(dists, ids, axis=1)
+        else:
+            ids = np.broadcast_to(np.arange(num_buffered), dists.shape)
+        order = np.argsort(dists, axis=1)
+        ids = np.take_along_axis(ids, order, axis=1)
+        dists = np.take_along_axis(dists, order, axis=1)
+
+        for doc, matches, match_ids, match_dists in zip(
+            docs, buffer_matches, ids, dists
+        ):
+            for idx, dist in zip(match_ids, match_dists):
+                match = Document(self._buffer_indexer[int(idx)], copy=True)
+                s = NamedScore()
+                s.value = dist
+                s.ref_id = doc.id
+                match.scores[self.metric] = s
+                matches.append(match)
+        return buffer_matches
+
+    def _rollback_add(self, num_indexes: int, doc_ids: List[str]):
+        indexer = self._vec_indexer
+        if indexer is None or indexer.ntotal <= num_indexes:
+            return
+
+        num_added = indexer.ntotal - num_indexes
+        try:
+            indexer.remove_ids(faiss.IDSelectorRange(num_indexes, indexer.ntotal))
+        except RuntimeError:
+            # e.g., HNSW does not support removal, hide the added vectors instead
+            self._metas['delete_marks'][num_indexes : num_indexes + num_added] = 1
+            self._num_deletes += num_added
+            return
+
+        for doc_id in doc_ids:
+            if self._metas['doc_id_to_offset'].get(doc_id, -1) >= num_indexes:
+                del self._metas['doc_id_to_offset'][doc_id]
+
     def bloom_filter(self, docs: DocumentArray):
         new_docs = DocumentArray()
         exist_docs = DocumentArray()
@@ -350,7 +792,7 @@ class FaissIndexer(Executor):
 
     @property
     def total_deletes(self):
-        return sum(self._metas['delete_marks'])
+        return self._num_deletes
 
     @property
     def total_updates(self):
@@ -31,34 +31,45 @@ class LMDBStorage(Storage):
         )
 
     def put(self, docs: DocumentArray):
+        items = self._serialize(docs)
         with self._env.begin(write=True) as txn:
-            for doc in docs:
-                # enforce using float32 as dtype of embeddings
-                doc.embedding = doc.embedding.astype(np.float32)
-                txn.put(doc.id.encode(), doc.to_bytes(), overwrite=True)
+            txn.cursor().putmulti(items, overwrite=True)
 
     def update(self, docs: DocumentArray):
+        items = self._serialize(docs)
         with self._env.begin(write=True) as txn:
-            for doc in docs:
-                doc.embedding = doc.embedding.astype(np.float32)
-                old_value = txn.replace(doc.id.encode(), doc.to_bytes())
+            for (key, value), doc in zip(items, docs):
+                old_value = txn.replace(key, value)
                 if not old_value:
                     txn.abort()
                     raise ValueError(f'The Doc ({doc.id}) does not exist in database!')
 
+    def _serialize(self, docs: DocumentArray):
+        # serialize before opening the write transaction to keep the writer lock short
+        items = []
+        for doc in docs:
+            # enforce using float32 as dtype of embeddings
+            doc.embedding = doc.embedding.astype(np.float32)
+            items.append((doc.id.encode(), doc.to_bytes()))
+        return items
+
     def delete(self, doc_ids: List[str]):
+        keys = [doc_id.encode() for doc_id in doc_ids]
         with self._env.begin(write=True) as txn:
-            for doc_id in doc_ids:
-                txn.delete(doc_id.encode())
+            for key in keys:
+                txn.delete(key)
 
     def get(self, doc_ids: Union[str, list]) -> DocumentArray:
         docs = DocumentArray()
         if isinstance(doc_ids, str):
             doc_ids = [doc_ids]
 
-        with self._env.begin(write=False) as txn:
-            for doc_id in doc_ids:
-                buffer = txn.get(doc_id.encode())
+        keys = [doc_id.encode() for doc_id in doc_ids]
+        # buffers=True returns memoryviews into the memory map instead of bytes copies,
+        # they are only valid inside the transaction, so the docs are parsed here
+        with self._env.begin(write=False, buffers=True) as txn:
+            for key in keys:
+                buffer = txn.get(key)
                 if buffer:
                     doc = Document.from_bytes(buffer)
                     docs.append(doc)
@@ -80,7 +91,7 @@ class LMDBStorage(Storage):
     def batched_iterator(self, batch_size: int = 1, **kwargs):
         count = 0
         docs = DocumentArray()
-        with self._env.begin(write=False) as txn:
+        with self._env.begin(write=False, buffers=True) as txn:
             cursor = txn.cursor()
             cursor.iternext()
             iterator = cursor.iternext(keys=False, values=True)
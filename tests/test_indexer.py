@@ -1,11 +1,14 @@
 import shutil
 from copy import deepcopy
+import faiss
+import numpy as np
 import pytest
-from jina import DocumentArray
+from jina import Document, DocumentArray
 from executor import FaissIndexer
+from executor import indexer as indexer_module
 
 
-@pytest.mark.parametrize('index_key', ['Flat', 'HNSW'])
+@pytest.mark.parametrize('index_key', ['Flat', 'HNSW', 'SQfp16'])
 def test_index(tmpdir, docs, index_key):
     metas = {'workspace': str(tmpdir)}
     indexer1 = FaissIndexer(index_key=index_key, metas=metas)
@@ -65,6 +68,8 @@ def test_delete(tmpdir, docs):
     # delete from empty storage
     parameters = {'ids': [f'doc{i}' for i in range(4, 7)]}
     indexer.delete(parameters)
+    assert indexer.total_deletes == 6
+    assert indexer.size == 0
 
 
 def test_update(tmpdir, docs, update_docs):
@@ -143,6 +148,13 @@ def test_search(tmpdir, metric, docs):
     for i in range(len(docs)):
         assert len(search_docs[i].matches) == 1
 
+    # test search without reading the matched docs from the storage
+    search_docs = deepcopy(docs)
+    indexer.search(search_docs, parameters={'return_docs': False})
+    for i in range(len(docs)):
+        assert search_docs[i].matches[0].id == f'doc{i + 1}'
+        assert search_docs[i].matches[0].embedding is None
+
     # test search from empty indexed docs
     shutil.rmtree(tmpdir)
     indexer = FaissIndexer(metas=metas)
@@ -196,3 +208,258 @@ def test_sql_backend(tmpdir, docs, update_docs):
     search_docs = deepcopy(update_docs)
     indexer.search(search_docs)
     search_docs[0].matches[0].id == f'doc1'
+
+
+@pytest.mark.parametrize('max_scores', [1 << 22, 64])
+def test_flat_search_matches_faiss(tmpdir, monkeypatch, max_scores):
+    # a small max_scores splits the vectors into several blocks
+    monkeypatch.setattr(indexer_module, '_MATMUL_MAX_SCORES', max_scores)
+    metas = {'workspace': str(tmpdir)}
+    rng = np.random.default_rng(0)
+    docs = DocumentArray(
+        [Document(id=f'doc{i}', embedding=rng.random(16)) for i in range(50)]
+    )
+
+    indexer = FaissIndexer(metas=metas)
+    indexer.index(docs)
+
+    queries = np.ascontiguousarray(rng.random((32, 16)), dtype=np.float32)
+    for top_k in (5, 50):
+        dists, ids = indexer._search_vecs(queries, top_k)
+        expected_dists, expected_ids = indexer._vec_indexer.search(queries, top_k)
+        assert (ids == expected_ids).all()
+        np.testing.assert_allclose(dists, expected_dists, rtol=1e-5)
+
+
+@pytest.mark.parametrize('index_key', ['IVF2,Flat', 'IVF2,SQ8', 'SQ8'])
+def test_train(tmpdir, docs, index_key):
+    metas = {'workspace': str(tmpdir)}
+
+    # the docs can not be added before the index is trained
+    indexer = FaissIndexer(index_key=index_key, metas=metas)
+    indexer.index(docs)
+    assert indexer.total_indexes == 0
+
+    # sync trains the index on the stored docs
+    indexer.sync()
+    assert indexer._vec_indexer.is_trained
+    if index_key.startswith('IVF'):
+        assert faiss.extract_index_ivf(indexer._vec_indexer).nprobe == 1
+    assert indexer.total_indexes == 6
+
+    search_docs = deepcopy(docs)
+    indexer.search(search_docs)
+    for i in range(len(docs)):
+        assert search_docs[i].matches[0].id == f'doc{i + 1}'
+
+
+def test_checkpoint(tmpdir, docs):
+    metas = {'workspace': str(tmpdir)}
+
+    indexer1 = FaissIndexer(metas=metas)
+    indexer1.index(docs)
+    indexer1.delete({'ids': ['doc1']})
+    indexer1.close()
+    assert (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+
+    # the index and its metas are loaded from the checkpoint
+    indexer2 = FaissIndexer(metas=metas)
+    assert not (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+    assert indexer2.total_indexes == 6
+    assert indexer2.total_deletes == 1
+    assert indexer2.size == 5
+
+    search_docs = deepcopy(docs)
+    indexer2.search(search_docs)
+    for i in range(1, len(docs)):
+        assert search_docs[i].matches[0].id == f'doc{i + 1}'
+        assert len(search_docs[i].matches) == 5
+
+    # the checkpoint is skipped when the storage changed since it was saved
+    indexer2.close()
+    indexer2._kv_db.delete(['doc2'])
+    indexer3 = FaissIndexer(metas=metas)
+    assert indexer3.total_indexes == 4
+    assert indexer3.total_deletes == 0
+
+    # the checkpoint is skipped when the index params changed
+    indexer3.close()
+    indexer4 = FaissIndexer(metas=metas, nprobe=4)
+    assert not (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+    assert indexer4.total_indexes == 4
+
+
+def test_checkpoint_not_synced(tmpdir, docs, update_docs):
+    metas = {'workspace': str(tmpdir)}
+
+    indexer1 = FaissIndexer(metas=metas)
+    indexer1.index(docs)
+    indexer1.update(update_docs, parameters={'sync': False})
+    indexer1.close()
+
+    # the update is not in the index, so no checkpoint is saved
+    assert not (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+    indexer2 = FaissIndexer(metas=metas)
+    search_docs = deepcopy(update_docs)
+    indexer2.search(search_docs)
+    scores = {m.id: m.scores['cosine'].value for m in search_docs[0].matches}
+    assert scores['doc1'] == pytest.approx(0)
+
+
+def test_train_not_enough_data(tmpdir, docs):
+    metas = {'workspace': str(tmpdir)}
+
+    # 6 docs are not enough to train 64 centroids, the index stays untrained
+    indexer1 = FaissIndexer(index_key='IVF64,Flat', metas=metas)
+    indexer1.index(docs)
+    indexer1.sync()
+    assert not indexer1._vec_indexer.is_trained
+    assert indexer1.total_indexes == 0
+
+    search_docs = deepcopy(docs)
+    indexer1.search(search_docs)
+    for doc in search_docs:
+        assert not doc.matches
+
+    # the executor still starts on the workspace
+    indexer2 = FaissIndexer(index_key='IVF64,Flat', metas=metas)
+    assert not indexer2._vec_indexer.is_trained
+
+
+@pytest.mark.parametrize('index_key', ['Flat', 'HNSW'])
+def test_index_storage_failure(tmpdir, docs, index_key):
+    metas = {'workspace': str(tmpdir)}
+    indexer = FaissIndexer(index_key=index_key, metas=metas)
+
+    def failing_put(docs):
+        raise RuntimeError('storage is down')
+
+    put = indexer._kv_db.put
+    indexer._kv_db.put = failing_put
+    with pytest.raises(RuntimeError, match='storage is down'):
+        indexer.index(docs)
+    assert indexer.size == 0
+
+    search_docs = deepcopy(docs)
+    indexer.search(search_docs, parameters={'return_docs': False})
+    for doc in search_docs:
+        assert not doc.matches
+
+    # a retry indexes the docs once
+    indexer._kv_db.put = put
+    indexer.index(docs)
+    assert indexer.size == 6
+    search_docs = deepcopy(docs)
+    indexer.search(search_docs)
+    for i in range(len(docs)):
+        assert search_docs[i].matches[0].id == f'doc{i + 1}'
+        assert len(search_docs[i].matches) == 6
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'cosine'])
+def test_match_buffer(tmpdir, docs, metric):
+    metas = {'workspace': str(tmpdir)}
+    rng = np.random.default_rng(0)
+
+    indexer = FaissIndexer(metric=metric, metas=metas)
+    indexer.index(docs)
+    indexer.update(
+        DocumentArray([Document(id=doc.id, embedding=rng.random(4)) for doc in docs])
+    )
+
+    queries = DocumentArray([Document(embedding=rng.random(4)) for _ in range(3)])
+    embeddings = np.ascontiguousarray(queries.embeddings, dtype=np.float32)
+    if metric == 'cosine':
+        indexer_module._normalize_inplace(embeddings)
+    buffer_matches = indexer._match_buffer(queries, embeddings, 4)
+
+    expected = deepcopy(queries)
+    expected.match(indexer._buffer_indexer, limit=4, metric=metric)
+    for matches, expected_doc in zip(buffer_matches, expected):
+        assert [m.id for m in matches] == expected_doc.matches[:, 'id']
+        np.testing.assert_allclose(
+            [m.scores[metric].value for m in matches],
+            [m.scores[metric].value for m in expected_doc.matches],
+            rtol=1e-5,
+            atol=1e-6,
+        )
+
+
+@pytest.mark.skipif(faiss.get_num_gpus() > 0, reason='a GPU is available')
+def test_use_gpu_without_gpu(tmpdir, docs):
+    metas = {'workspace': str(tmpdir)}
+
+    indexer1 = FaissIndexer(use_gpu=True, metas=metas)
+    indexer1.index(docs)
+    assert not indexer1._on_gpu
+    assert isinstance(indexer1._vec_indexer, faiss.IndexFlat)
+    assert isinstance(indexer1._to_cpu(indexer1._vec_indexer), faiss.IndexFlat)
+
+    indexer1.close()
+    assert (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+    indexer2 = FaissIndexer(use_gpu=True, metas=metas)
+    assert isinstance(indexer2._vec_indexer, faiss.IndexFlat)
+    assert indexer2.total_indexes == 6
+
+
+@pytest.mark.skipif(faiss.get_num_gpus() == 0, reason='no GPU is available')
+def test_use_gpu(tmpdir, docs):
+    metas = {'workspace': str(tmpdir)}
+
+    indexer1 = FaissIndexer(use_gpu=True, metas=metas)
+    indexer1.index(docs)
+    assert indexer1._on_gpu
+    assert not isinstance(indexer1._vec_indexer, faiss.IndexFlat)
+    assert indexer1.total_indexes == 6
+
+    search_docs = deepcopy(docs)
+    indexer1.search(search_docs)
+    for i in range(len(docs)):
+        assert search_docs[i].matches[0].id == f'doc{i + 1}'
+
+    # the checkpoint is written from a CPU copy and moved back to GPU on load
+    indexer1.close()
+    assert (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+    indexer2 = FaissIndexer(use_gpu=True, metas=metas)
+    assert not isinstance(indexer2._vec_indexer, faiss.IndexFlat)
+    assert indexer2.total_indexes == 6
+
+
+@pytest.mark.parametrize('index_key', ['IVF2,Flat', 'SQ8'])
+def test_checkpoint_untrained(tmpdir, docs, index_key):
+    metas = {'workspace': str(tmpdir)}
+
+    # the docs are stored, but not indexed, as the index is not trained yet
+    indexer1 = FaissIndexer(index_key=index_key, metas=metas)
+    indexer1.index(docs)
+    assert not indexer1._vec_indexer.is_trained
+    indexer1.close()
+    assert not (tmpdir / 'FaissIndexer' / 'index.faiss').exists()
+
+    # the next start trains the index on the stored docs
+    indexer2 = FaissIndexer(index_key=index_key, metas=metas)
+    assert indexer2._vec_indexer.is_trained
+    assert indexer2.total_indexes == 6
+
+
+def test_checkpoint_trained_index_file(tmpdir, docs, monkeypatch):
+    metas = {'workspace': str(tmpdir)}
+    trained_index_file = str(tmpdir / 'trained.index')
+    faiss.write_index(faiss.IndexFlatIP(4), trained_index_file)
+
+    indexer1 = FaissIndexer(trained_index_file=trained_index_file, metas=metas)
+    indexer1.index(docs)
+    indexer1.close()
+
+    # the checkpoint was built from another trained index file, it is rebuilt
+    builds = []
+    build_indexer = FaissIndexer._build_indexer
+
+    def spy_build_indexer(self, *args, **kwargs):
+        builds.append(args)
+        return build_indexer(self, *args, **kwargs)
+
+    monkeypatch.setattr(FaissIndexer, '_build_indexer', spy_build_indexer)
+    indexer2 = FaissIndexer(metas=metas)
+    assert len(builds) == 1
+    assert indexer2.total_indexes == 6